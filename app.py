@@ -1,14 +1,23 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Request
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse, StreamingResponse
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, FileResponse, StreamingResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-import os, json, uuid, time, datetime, shutil, math, re, tempfile, subprocess, asyncio, platform, zipfile
+import os, json, uuid, time, datetime, shutil, math, re, tempfile, subprocess, asyncio, platform, zipfile, threading, functools, gzip, sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Callable
 from b2sdk.v2 import B2Api, InMemoryAccountInfo
 import httpx
 import mimetypes
 import psutil
+import zlib
+import importlib.util
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # zstd compression is optional, gzip is always available
 
 # B2 Configuration
 B2_APPLICATION_KEY_ID = "bec925575d01"
@@ -36,6 +45,69 @@ MAX_CONCURRENT_UPLOADS = 4  # Limited for single vCPU
 MEMORY_BUFFER = min(256 * 1024 * 1024, TOTAL_MEMORY // 4)  # 256MB or 1/4 of RAM
 CACHE_EXPIRY = 3 * 60 * 60  # 3 hours cache expiry
 
+# Adaptive chunk sizing - download read sizes follow measured per-connection throughput
+MIN_CHUNK_SIZE = min(256 * 1024, CHUNK_SIZE)  # 256KB floor for slow (mobile) clients
+MAX_CHUNK_SIZE = min(4 * 1024 * 1024, CHUNK_SIZE)  # 4MB ceiling on what a single download buffers
+INITIAL_CHUNK_SIZE = min(1024 * 1024, MAX_CHUNK_SIZE)  # Start at 1MB until we have a measurement
+CHUNK_TARGET_SECONDS = 0.5  # Aim for each chunk to take about this long to move
+CHUNK_SMOOTHING = 0.3  # Weight of the newest sample in the throughput moving average
+IO_WORKERS = MAX_CONCURRENT_UPLOADS  # Threads for write-behind disk I/O
+
+# Thread pool for blocking disk I/O so writes and fsync never stall the event loop
+io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="io")
+
+# Bounded pool for other blocking work (rclone setup, metadata, storage scans) called from async handlers
+BLOCKING_WORKERS = 4
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_WORKERS, thread_name_prefix="blocking")
+
+# Event loop lag monitoring
+LOOP_LAG_INTERVAL = 0.5  # Seconds between lag probes
+LOOP_LAG_SAMPLES = 1200  # Keep the last ~10 minutes of samples
+loop_lag_samples = deque(maxlen=LOOP_LAG_SAMPLES)
+
+# Serializes read-modify-write cycles on the files database across worker threads
+files_db_lock = threading.Lock()
+
+# On-the-fly compression for compressible file types
+COMPRESSION_ENCODING = "zstd" if zstandard else "gzip"  # Preferred stored encoding
+COMPRESSION_MIN_SIZE = 64 * 1024  # Skip files too small to benefit
+COMPRESSION_SAMPLE_SIZE = 256 * 1024  # Bytes of the first chunk used for the compressibility probe
+COMPRESSION_MIN_RATIO = 1.5  # Sample must shrink at least this much to be worth compressing
+DECOMPRESS_WORKERS = 4  # Threads reserved for decompressing downloads
+DECOMPRESS_MAX_READ_SIZE = 1024 * 1024  # Largest decompressed chunk read at once
+
+# Decompressing reads wait on B2, keep them off the shared blocking pool
+decompress_executor = ThreadPoolExecutor(max_workers=DECOMPRESS_WORKERS, thread_name_prefix="decompress")
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+# Small-file packing - tiny files of one transfer are stored as a single pack object
+PACK_THRESHOLD = 4 * 1024 * 1024  # Files smaller than 4MB go into the pack
+PACK_MIN_FILES = 2  # Only pack when at least this many small files are in a transfer
+
+# Preview generation - thumbnails and short video previews for the landing page
+FFMPEG_PATH = shutil.which("ffmpeg")
+PREVIEW_WORKERS = 1  # Rendering is CPU heavy, keep a single worker on a single vCPU
+PREVIEW_MAX_WIDTH = 480  # Longest thumbnail edge / video preview width in pixels
+PREVIEW_VIDEO_SECONDS = 6  # Length of the video preview clip
+PREVIEW_TIMEOUT = 120  # Give up on a single preview after this many seconds
+PREVIEW_CACHE_SECONDS = FILE_EXPIRY_DAYS * 24 * 60 * 60  # Previews never change, cache them until expiry
+PREVIEW_FORMATS = {"image": (".jpg", "image/jpeg"), "video": (".mp4", "video/mp4")}
+
+# Pillow is optional, ffmpeg is used for image thumbnails without it
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+PILLOW_THUMBNAIL_SCRIPT = """import sys
+from PIL import Image
+with Image.open(sys.argv[1]) as img:
+    img.thumbnail((int(sys.argv[3]), int(sys.argv[3])))
+    img.convert("RGB").save(sys.argv[2], "JPEG", quality=75, optimize=True)
+"""
+
+# Renderers run as separate processes (killable on timeout), this bounds how many run at once
+preview_semaphore = asyncio.Semaphore(PREVIEW_WORKERS)
+
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/xml", "application/javascript", "application/x-ndjson", "application/sql", "application/x-yaml", "application/yaml", "image/svg+xml")
+COMPRESSIBLE_EXTENSIONS = (".log", ".jsonl", ".ndjson", ".yaml", ".yml", ".csv", ".tsv", ".sql", ".txt", ".md", ".ini", ".toml")  # mimetypes misses several of these
+
 # Background images configuration
 BACKGROUND_IMAGES = [{"url": "https://f004.backblazeb2.com/file/fdmbucket/backgrounds/bg1.jpg", "credit": "Foto: Francesco Ungaro na Pexels"}, {"url": "https://f004.backblazeb2.com/file/fdmbucket/backgrounds/bg2.jpg", "credit": "Foto: Francesco Ungaro na Pexels"}, {"url": "https://f004.backblazeb2.com/file/fdmbucket/backgrounds/bg3.jpg", "credit": "Foto: Francesco Ungaro na Pexels"}]
 
@@ -54,6 +126,208 @@ if not os.path.exists(FILES_DB):
         json.dump({}, f)
 
 
+async def run_blocking(func: Callable, *args, **kwargs):
+    """Run a blocking function on the bounded thread pool without stalling the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
+
+
+async def monitor_event_loop_lag() -> None:
+    """Sample how late the event loop wakes up from a fixed sleep"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag_samples.append(max(0.0, loop.time() - start - LOOP_LAG_INTERVAL))
+
+
+def get_loop_lag_stats() -> Dict[str, Any]:
+    """Summarize recent event loop lag samples in milliseconds"""
+    samples = sorted(loop_lag_samples)
+    if not samples:
+        return {"samples": 0, "p50_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+
+    def percentile(p: float) -> float:
+        index = min(len(samples) - 1, int(math.ceil(p * len(samples))) - 1)
+        return round(samples[max(0, index)] * 1000, 2)
+
+    return {"samples": len(samples), "p50_ms": percentile(0.50), "p99_ms": percentile(0.99), "max_ms": round(samples[-1] * 1000, 2)}
+
+
+class ThroughputTracker:
+    """Track throughput of a single connection and pick the next chunk size"""
+
+    def __init__(self, initial_size: int = INITIAL_CHUNK_SIZE, max_size: int = MAX_CHUNK_SIZE):
+        self.max_size = max(MIN_CHUNK_SIZE, max_size)
+        self.chunk_size = min(initial_size, self.max_size)
+        self.throughput = None  # Smoothed bytes per second
+
+    def record(self, num_bytes: int, elapsed: float) -> int:
+        """Record a transferred chunk and return the chunk size to use next"""
+        if num_bytes <= 0 or elapsed <= 0:
+            return self.chunk_size
+
+        sample = num_bytes / elapsed
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput = CHUNK_SMOOTHING * sample + (1 - CHUNK_SMOOTHING) * self.throughput
+
+        # Size the next chunk to take roughly CHUNK_TARGET_SECONDS, growing at most 2x per step
+        target = int(self.throughput * CHUNK_TARGET_SECONDS)
+        target = min(target, self.chunk_size * 2)
+        target = max(MIN_CHUNK_SIZE, min(self.max_size, target))
+
+        # Round down to a multiple of the minimum size to keep buffers aligned
+        self.chunk_size = max(MIN_CHUNK_SIZE, target - target % MIN_CHUNK_SIZE)
+        return self.chunk_size
+
+
+def is_compressible_type(content_type: str, filename: str) -> bool:
+    """Check whether the declared or guessed content type is worth compressing"""
+    guessed_type, guessed_encoding = mimetypes.guess_type(filename)
+    if guessed_encoding:
+        return False  # Already compressed (.gz, .bz2, ...)
+    if any(t and t.startswith(COMPRESSIBLE_TYPES) for t in (content_type, guessed_type)):
+        return True
+    # Browsers send application/octet-stream for unknown types like .log, fall back to the extension
+    return filename.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+
+def choose_content_encoding(content_type: str, filename: str, file_size: int, sample: bytes) -> str:
+    """Pick a storage encoding for an upload, or None to store it as-is"""
+    if file_size < COMPRESSION_MIN_SIZE or not is_compressible_type(content_type, filename):
+        return None
+
+    # Probe with fast deflate on a sample from the start of the file
+    sample = sample[:COMPRESSION_SAMPLE_SIZE]
+    if not sample:
+        return None
+    ratio = len(sample) / max(1, len(zlib.compress(sample, 1)))
+    return COMPRESSION_ENCODING if ratio >= COMPRESSION_MIN_RATIO else None
+
+
+def make_compressor(encoding: str):
+    """Create a streaming compressor with compress()/flush() for the given encoding"""
+    if encoding == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def can_decompress(encoding: str) -> bool:
+    """Check whether stored objects with this encoding can be decompressed here"""
+    return encoding == "gzip" or (encoding == "zstd" and zstandard is not None)
+
+
+def open_decompressing_reader(encoding: str, source):
+    """Wrap a binary file object in a reader whose read1(n) returns at most n decompressed bytes"""
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=source, mode="rb")
+    if encoding == "zstd" and zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(source, read_size=MIN_CHUNK_SIZE)
+    raise ValueError(f"Unsupported content encoding: {encoding}")
+
+
+def accepts_encoding(accept_encoding: str, encoding: str) -> bool:
+    """Check if an Accept-Encoding header allows the given encoding"""
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if name.strip().lower() not in (encoding, "*"):
+            continue
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                return float(q[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def build_pack(members: list, pack_file_path: str) -> None:
+    """Concatenate member temp files into one pack file, recording each member's byte range"""
+    with open(pack_file_path, "wb", buffering=MEMORY_BUFFER) as pack_file:
+        for member in members:
+            offset = pack_file.tell()
+            with open(member["temp_file_path"], "rb") as member_file:
+                shutil.copyfileobj(member_file, pack_file, MIN_CHUNK_SIZE)
+            member["pack_offset"] = offset
+            member["pack_length"] = pack_file.tell() - offset
+        pack_file.flush()
+        os.fsync(pack_file.fileno())
+
+
+def get_preview_kind(content_type: str) -> str:
+    """Return the preview kind for a content type, or None if no local tool can render it"""
+    if content_type.startswith("video/") and FFMPEG_PATH:
+        return "video"
+    if content_type.startswith("image/") and content_type != "image/svg+xml" and (PILLOW_AVAILABLE or FFMPEG_PATH):
+        return "image"
+    return None
+
+
+async def render_preview(source_path: str, kind: str, output_path: str) -> bool:
+    """Render an image thumbnail or a short low-bitrate video preview in a separate process"""
+    if kind == "image" and PILLOW_AVAILABLE:
+        args = [sys.executable, "-c", PILLOW_THUMBNAIL_SCRIPT, source_path, output_path, str(PREVIEW_MAX_WIDTH)]
+    elif FFMPEG_PATH:
+        scale = f"scale='min({PREVIEW_MAX_WIDTH},iw)':-2"
+        if kind == "image":
+            args = [FFMPEG_PATH, "-y", "-loglevel", "error", "-i", source_path, "-vf", scale, "-frames:v", "1", "-q:v", "5", output_path]
+        else:
+            args = [FFMPEG_PATH, "-y", "-loglevel", "error", "-t", str(PREVIEW_VIDEO_SECONDS), "-i", source_path, "-vf", scale, "-an", "-c:v", "libx264", "-preset", "veryfast", "-crf", "32", "-maxrate", "400k", "-bufsize", "800k", "-pix_fmt", "yuv420p", "-movflags", "+faststart", output_path]
+    else:
+        return False
+
+    async with preview_semaphore:
+        process = None
+        try:
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE)
+            _, stderr = await asyncio.wait_for(process.communicate(), timeout=PREVIEW_TIMEOUT)
+            if process.returncode != 0:
+                print(f"Preview rendering failed for {source_path}: {stderr.decode(errors='replace')}")
+                return False
+            return os.path.exists(output_path)
+        except asyncio.TimeoutError:
+            print(f"Preview rendering timed out for {source_path}")
+            return False
+        except Exception as e:
+            print(f"Error rendering preview for {source_path}: {str(e)}")
+            return False
+        finally:
+            if process is not None and process.returncode is None:
+                try:
+                    process.kill()
+                    await process.wait()
+                except ProcessLookupError:
+                    pass
+
+
+def parse_byte_range(range_header: str, size: int):
+    """Parse a single-range 'bytes=' header into inclusive (start, end), None to serve the whole body"""
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None  # Missing, other units or multiple ranges: answer with the full body
+
+    start_text, _, end_text = range_header[len("bytes="):].strip().partition("-")
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else size - 1
+        else:
+            start = size - int(end_text)  # Suffix range: last N bytes
+            end = size - 1
+    except ValueError:
+        return None
+
+    start = max(0, start)
+    end = min(end, size - 1)
+    if start > end:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
 def get_temp_storage_usage():
     """Get current usage of temporary storage"""
     total_size = 0
@@ -251,10 +525,10 @@ def ensure_rclone():
 
 # Create optimized rclone configuration
 def create_rclone_config():
-    """Create optimized rclone configuration file"""
-    config_path = os.path.join(os.getcwd(), "rclone.conf")
+    """Create optimized rclone configuration file, private to the caller who must remove it"""
+    fd, config_path = tempfile.mkstemp(prefix="rclone-", suffix=".conf")
     try:
-        with open(config_path, "w") as f:
+        with os.fdopen(fd, "w") as f:
             f.write(
                 f"""[b2]
 type = b2
@@ -287,17 +561,10 @@ def save_file_metadata(unique_id: str, files_data: list) -> None:
     """Save file metadata to the JSON database with expiry date"""
     expiry_date = int(time.time() + (FILE_EXPIRY_DAYS * 24 * 60 * 60))  # Current time + 7 days in seconds
 
-    with open(FILES_DB, "r+") as f:
-        try:
-            files = json.load(f) if os.path.getsize(FILES_DB) > 0 else {}
-        except json.JSONDecodeError:
-            files = {}
-
+    with files_db_lock:
+        files = load_files_db() or {}
         files[unique_id] = {"files": files_data, "upload_date": int(time.time()), "expiry_date": expiry_date}
-
-        f.seek(0)
-        f.truncate(0)
-        json.dump(files, f, indent=2)
+        write_files_db(files)
 
 
 def get_file_metadata(file_id: str) -> Dict[str, Any]:
@@ -305,7 +572,7 @@ def get_file_metadata(file_id: str) -> Dict[str, Any]:
     if not os.path.exists(FILES_DB):
         return None
 
-    with open(FILES_DB, "r") as f:
+    with files_db_lock, open(FILES_DB, "r") as f:
         try:
             files = json.load(f)
             return files.get(file_id)
@@ -313,6 +580,65 @@ def get_file_metadata(file_id: str) -> Dict[str, Any]:
             return None
 
 
+def load_files_db() -> Dict[str, Any]:
+    """Load the whole JSON database, returning None if it cannot be read"""
+    if not os.path.exists(FILES_DB):
+        return None
+
+    try:
+        with open(FILES_DB, "r") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, IOError) as e:
+        print(f"Error reading files database: {str(e)}")
+        return None
+
+
+def snapshot_files_db() -> Dict[str, Any]:
+    """Load the whole JSON database while holding the database lock"""
+    with files_db_lock:
+        return load_files_db()
+
+
+def write_files_db(files: Dict[str, Any]) -> None:
+    """Atomically replace the JSON database so readers never see a partial write"""
+    temp_path = f"{FILES_DB}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(files, f, indent=2)
+        os.replace(temp_path, FILES_DB)
+    except IOError as e:
+        print(f"Error writing to files database: {str(e)}")
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def remove_file_metadata(file_ids: list) -> None:
+    """Remove entries from the JSON database, keeping anything saved meanwhile"""
+    with files_db_lock:
+        files = load_files_db()
+        if files is None:
+            return
+
+        for file_id in file_ids:
+            files.pop(file_id, None)
+
+        write_files_db(files)
+
+
+def update_file_previews(unique_id: str, previews: Dict[str, Dict[str, str]]) -> None:
+    """Attach generated previews (keyed by filename) to an upload's metadata"""
+    with files_db_lock:
+        files = load_files_db()
+        if not files or unique_id not in files:
+            return
+
+        for file_info in files[unique_id].get("files", []):
+            if file_info.get("filename") in previews:
+                file_info.update(previews[file_info["filename"]])
+
+        write_files_db(files)
+
+
 def cleanup_expired_files(background_tasks: BackgroundTasks) -> None:
     """Queue the cleanup tasks to run in the background"""
     background_tasks.add_task(_delete_expired_files)
@@ -323,14 +649,8 @@ async def _delete_expired_files() -> None:
     """Delete expired files from B2 and update the database"""
     current_time = int(time.time())
 
-    if not os.path.exists(FILES_DB):
-        return
-
-    try:
-        with open(FILES_DB, "r") as f:
-            files = json.load(f)
-    except (json.JSONDecodeError, IOError) as e:
-        print(f"Error reading files database: {str(e)}")
+    files = await run_blocking(snapshot_files_db)
+    if files is None:
         return
 
     files_to_delete = []
@@ -341,37 +661,94 @@ async def _delete_expired_files() -> None:
     if not files_to_delete:
         return
 
-    # Ensure rclone is available
+    # Ensure rclone is available and create a config for this sweep
     try:
-        rclone_path = ensure_rclone()
+        rclone_path = await run_blocking(ensure_rclone)
+        rclone_config = await run_blocking(create_rclone_config)
     except Exception as e:
         print(f"Error ensuring rclone is available: {str(e)}")
         return
 
     # Delete expired files and update the database
-    for file_id, file_data in files_to_delete:
-        try:
-            # Delete all files from B2
-            for file_info in file_data.get("files", []):
-                file_path = file_info.get("file_path")
-                if file_path:
-                    try:
+    deleted_ids = []
+    try:
+        for file_id, file_data in files_to_delete:
+            try:
+                # Delete all files and previews from B2 (packed files share one object)
+                file_paths = dict.fromkeys(path for f in file_data.get("files", []) for path in (f.get("file_path"), f.get("preview_path")))
+                for file_path in file_paths:
+                    if file_path:
                         # Use rclone to delete the file
-                        subprocess.run([rclone_path, "--config", os.path.join(os.getcwd(), "rclone.conf"), "delete", f"b2:{B2_BUCKET_NAME}/{file_path}"], check=True, capture_output=True)
-                    except subprocess.CalledProcessError as e:
-                        print(f"Error deleting file {file_path}: {e.stderr.decode()}")
+                        process = await asyncio.create_subprocess_exec(rclone_path, "--config", rclone_config, "delete", f"b2:{B2_BUCKET_NAME}/{file_path}", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+                        _, stderr = await process.communicate()
+                        if process.returncode != 0:
+                            print(f"Error deleting file {file_path}: {stderr.decode()}")
 
-            # Remove from our database
-            del files[file_id]
+                # Remove from our database
+                deleted_ids.append(file_id)
+            except Exception as e:
+                print(f"Error deleting expired file {file_id}: {str(e)}")
+    finally:
+        try:
+            if os.path.exists(rclone_config):
+                os.remove(rclone_config)
         except Exception as e:
-            print(f"Error deleting expired file {file_id}: {str(e)}")
+            print(f"Error cleaning up rclone config: {str(e)}")
 
     # Update the database
+    if deleted_ids:
+        await run_blocking(remove_file_metadata, deleted_ids)
+
+
+async def generate_previews(unique_id: str, unique_folder: str, jobs: list) -> None:
+    """Render previews for a finished upload, store them in B2 and record them in the metadata"""
+    previews = {}
+    rclone_config = None
+
+    async def process_job(job: dict) -> None:
+        extension, content_type = PREVIEW_FORMATS[job["kind"]]
+        output_path = f"{job['source']}{extension}"
+        try:
+            if not await render_preview(job["source"], job["kind"], output_path):
+                return
+
+            preview_path = f"{unique_folder}/.preview/{uuid.uuid4()}{extension}"
+            if await upload_to_b2(output_path, preview_path, rclone_path, rclone_config, headers={"Cache-Control": f"public, max-age={PREVIEW_CACHE_SECONDS}, immutable"}):
+                previews[job["filename"]] = {"preview_path": preview_path, "preview_type": job["kind"], "preview_content_type": content_type}
+        except Exception as e:
+            print(f"Error generating preview for {job['filename']}: {str(e)}")
+        finally:
+            try:
+                if os.path.exists(output_path):
+                    os.unlink(output_path)
+            except Exception as e:
+                print(f"Error cleaning up preview file: {str(e)}")
+
     try:
-        with open(FILES_DB, "w") as f:
-            json.dump(files, f, indent=2)
-    except IOError as e:
-        print(f"Error writing to files database: {str(e)}")
+        rclone_path = await run_blocking(ensure_rclone)
+        rclone_config = await run_blocking(create_rclone_config)
+
+        # preview_semaphore bounds how many previews render at once
+        await asyncio.gather(*(process_job(job) for job in jobs))
+
+        if previews:
+            await run_blocking(update_file_previews, unique_id, previews)
+            print(f"Generated {len(previews)} previews for upload ID: {unique_id}")
+    except Exception as e:
+        print(f"Error during preview generation for {unique_id}: {str(e)}")
+    finally:
+        # Clean up preview sources and config
+        for job in jobs:
+            try:
+                if os.path.exists(job["source"]):
+                    os.unlink(job["source"])
+            except Exception as e:
+                print(f"Error cleaning up preview source: {str(e)}")
+        try:
+            if rclone_config and os.path.exists(rclone_config):
+                os.remove(rclone_config)
+        except Exception as e:
+            print(f"Error cleaning up rclone config: {str(e)}")
 
 
 def generate_unique_folder() -> str:
@@ -413,7 +790,7 @@ def validate_b2_filename(filename: str) -> bool:
         raise ValueError(f"Invalid filename: {str(e)}")
 
 
-async def upload_to_b2(local_file_path: str, b2_file_path: str, rclone_path: str, rclone_config: str) -> bool:
+async def upload_to_b2(local_file_path: str, b2_file_path: str, rclone_path: str, rclone_config: str, headers: Dict[str, str] = None) -> bool:
     """
     Upload a file to B2 using rclone
 
@@ -422,6 +799,7 @@ async def upload_to_b2(local_file_path: str, b2_file_path: str, rclone_path: str
         b2_file_path: Path where the file should be stored in B2
         rclone_path: Path to the rclone executable
         rclone_config: Path to the rclone config file
+        headers: Optional HTTP headers to store with the object (e.g. Cache-Control)
 
     Returns:
         bool: True if upload was successful, False otherwise
@@ -430,7 +808,8 @@ async def upload_to_b2(local_file_path: str, b2_file_path: str, rclone_path: str
         print(f"Starting B2 upload for {b2_file_path}")
 
         # Create rclone upload process
-        process = await asyncio.create_subprocess_exec(rclone_path, "--config", rclone_config, "copyto", "--progress", "--stats-one-line", "--stats", "1s", "--retries", "3", "--low-level-retries", "10", "--transfers", str(MAX_CONCURRENT_UPLOADS), local_file_path, f"b2:{B2_BUCKET_NAME}/{b2_file_path}", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        header_args = [arg for name, value in (headers or {}).items() for arg in ("--header-upload", f"{name}: {value}")]
+        process = await asyncio.create_subprocess_exec(rclone_path, "--config", rclone_config, "copyto", *header_args, "--progress", "--stats-one-line", "--stats", "1s", "--retries", "3", "--low-level-retries", "10", "--transfers", str(MAX_CONCURRENT_UPLOADS), local_file_path, f"b2:{B2_BUCKET_NAME}/{b2_file_path}", stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
 
         # Wait for the upload to complete
         stdout, stderr = await process.communicate()
@@ -454,6 +833,24 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
 
+@app.on_event("startup")
+async def start_loop_lag_monitor():
+    app.state.loop_lag_task = asyncio.create_task(monitor_event_loop_lag())
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    app.state.loop_lag_task.cancel()
+    io_executor.shutdown(wait=True)
+    blocking_executor.shutdown(wait=True)
+    decompress_executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.get("/metrics")
+async def metrics():
+    return JSONResponse(content={"event_loop_lag": get_loop_lag_stats()})
+
+
 @app.get("/", response_class=HTMLResponse)
 async def upload_page(request: Request, background_tasks: BackgroundTasks):
     # Clean up expired files in the background
@@ -463,20 +860,23 @@ async def upload_page(request: Request, background_tasks: BackgroundTasks):
 
 
 @app.post("/upload")
-async def upload_file(files: list[UploadFile] = File(...)):
+async def upload_file(background_tasks: BackgroundTasks, files: list[UploadFile] = File(...)):
     if not files:
         raise HTTPException(status_code=400, detail="No files provided")
 
+    pack_temp_files = []
+    preview_jobs = []
+    previews_scheduled = False
     try:
         # Calculate total upload size
         total_size = sum(f.size for f in files)
 
         # Check if we can accept the upload
-        if not should_accept_upload(total_size):
+        if not await run_blocking(should_accept_upload, total_size):
             raise HTTPException(status_code=507, detail="Insufficient storage space available. Please try again later.")
 
         # Ensure rclone is available
-        rclone_path = ensure_rclone()
+        rclone_path = await run_blocking(ensure_rclone)
         unique_folder = generate_unique_folder()
         print(f"\n=== Starting new upload session ===")
         print(f"Number of files: {len(files)}")
@@ -484,13 +884,13 @@ async def upload_file(files: list[UploadFile] = File(...)):
         print(f"Generated unique folder: {unique_folder}")
 
         # Create optimized rclone config
-        rclone_config = create_rclone_config()
+        rclone_config = await run_blocking(create_rclone_config)
 
         files_data = []
         upload_tasks = []
         semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
 
-        async def upload_single_file(file: UploadFile, file_path: str, content_type: str) -> dict:
+        async def upload_single_file(file: UploadFile, file_path: str, content_type: str, packed: bool = False) -> dict:
             async with semaphore:
                 try:
                     if not file.filename:
@@ -506,6 +906,7 @@ async def upload_file(files: list[UploadFile] = File(...)):
 
                     # Create a unique temporary file path
                     temp_file_path = os.path.join(TEMP_UPLOAD_DIR, f"{uuid.uuid4()}_{safe_filename}")
+                    keep_temp_file = False
 
                     try:
                         print("Starting file read...")
@@ -513,14 +914,36 @@ async def upload_file(files: list[UploadFile] = File(...)):
                         last_progress_time = time.time()
                         last_progress_size = 0
 
+                        loop = asyncio.get_running_loop()
+                        pending_write = None
+                        encoding = None
+                        compressor = None
+                        write_chunk = None
+
                         # Open file in binary write mode with optimized buffering
-                        with open(temp_file_path, "wb", buffering=MEMORY_BUFFER) as temp_file:
+                        temp_file = await loop.run_in_executor(io_executor, lambda: open(temp_file_path, "wb", buffering=MEMORY_BUFFER))
+                        try:
                             while True:
                                 try:
+                                    # The multipart body is already spooled locally, so read at a fixed size
                                     chunk = await asyncio.wait_for(file.read(CHUNK_SIZE), timeout=30.0)
                                     if not chunk:
                                         break
-                                    temp_file.write(chunk)
+
+                                    # Decide on compression from the first chunk
+                                    if write_chunk is None:
+                                        encoding = choose_content_encoding(content_type, safe_filename, file.size or 0, chunk)
+                                        if encoding:
+                                            print(f"Compressing {safe_filename} with {encoding}")
+                                            compressor = make_compressor(encoding)
+                                            write_chunk = lambda data: temp_file.write(compressor.compress(data))
+                                        else:
+                                            write_chunk = temp_file.write
+
+                                    # Write-behind: keep at most one write in flight while reading the next chunk
+                                    if pending_write is not None:
+                                        await pending_write
+                                    pending_write = loop.run_in_executor(io_executor, write_chunk, chunk)
                                     total_size += len(chunk)
 
                                     current_time = time.time()
@@ -536,6 +959,46 @@ async def upload_file(files: list[UploadFile] = File(...)):
                                     print("Upload timeout - connection too slow")
                                     raise HTTPException(status_code=408, detail="Upload timeout - connection too slow")
 
+                            if pending_write is not None:
+                                await pending_write
+                                pending_write = None
+
+                            if compressor is not None:
+                                await loop.run_in_executor(io_executor, lambda: temp_file.write(compressor.flush()))
+
+                            # Flush and fsync on the I/O pool so rclone sees the complete file
+                            await loop.run_in_executor(io_executor, temp_file.flush)
+                            await loop.run_in_executor(io_executor, os.fsync, temp_file.fileno())
+                        finally:
+                            if pending_write is not None:
+                                try:
+                                    await pending_write
+                                except Exception:
+                                    pass
+                            await loop.run_in_executor(io_executor, temp_file.close)
+
+                        # Keep a hard link to the received file for preview rendering after the upload
+                        preview_kind = get_preview_kind(content_type) if not encoding else None
+                        if preview_kind:
+                            preview_job = {"filename": safe_filename, "kind": preview_kind, "source": f"{temp_file_path}.preview"}
+                            preview_jobs.append(preview_job)  # Register first so cleanup finds the link even if we are cancelled
+                            try:
+                                await loop.run_in_executor(io_executor, os.link, temp_file_path, preview_job["source"])
+                            except OSError as e:
+                                preview_jobs.remove(preview_job)
+                                print(f"Skipping preview for {safe_filename}: {str(e)}")
+
+                        if packed:
+                            # Packed files are uploaded together once the whole transfer is received
+                            stored_size = await loop.run_in_executor(io_executor, os.path.getsize, temp_file_path)
+                            file_info = {"filename": safe_filename, "size": total_size, "content_type": content_type, "temp_file_path": temp_file_path}
+                            if encoding:
+                                file_info.update({"encoding": encoding, "stored_size": stored_size})
+                            keep_temp_file = True
+                            pack_temp_files.append(temp_file_path)
+                            print(f"File read complete, queued {safe_filename} for pack")
+                            return file_info
+
                         print("File read complete, starting B2 upload...")
 
                         # Upload to B2 using rclone
@@ -548,7 +1011,13 @@ async def upload_file(files: list[UploadFile] = File(...)):
                         file_url = f"{B2_ENDPOINT}/{file_path}"
                         print(f"File uploaded successfully: {file_url}")
 
-                        return {"url": file_url, "filename": safe_filename, "file_path": file_path, "size": total_size, "content_type": content_type}
+                        file_info = {"url": file_url, "filename": safe_filename, "file_path": file_path, "size": total_size, "content_type": content_type}
+                        if encoding:
+                            stored_size = await loop.run_in_executor(io_executor, os.path.getsize, temp_file_path)
+                            file_info.update({"encoding": encoding, "stored_size": stored_size})
+                            print(f"Stored {safe_filename} as {encoding}: {total_size} -> {stored_size} bytes")
+
+                        return file_info
 
                     except Exception as e:
                         print(f"Error processing file {file.filename}: {str(e)}")
@@ -556,8 +1025,8 @@ async def upload_file(files: list[UploadFile] = File(...)):
                     finally:
                         # Clean up temporary file
                         try:
-                            if os.path.exists(temp_file_path):
-                                os.unlink(temp_file_path)
+                            if not keep_temp_file and os.path.exists(temp_file_path):
+                                await asyncio.get_running_loop().run_in_executor(io_executor, os.unlink, temp_file_path)
                                 print("Temporary file cleaned up")
                         except Exception as e:
                             print(f"Error cleaning up temporary file: {str(e)}")
@@ -565,26 +1034,65 @@ async def upload_file(files: list[UploadFile] = File(...)):
                     print(f"Error processing file {file.filename}: {str(e)}")
                     raise HTTPException(status_code=500, detail=f"Error processing file {file.filename}: {str(e)}")
 
+        # Pack small files into a single object when there are enough of them
+        small_files = [f for f in files if (f.size or 0) < PACK_THRESHOLD]
+        use_pack = len(small_files) >= PACK_MIN_FILES
+        if use_pack:
+            print(f"Packing {len(small_files)} small files into one object")
+
         # Process files in parallel with resource limits
         for file in files:
             file_path = f"{unique_folder}/{file.filename}"
             content_type = file.content_type or mimetypes.guess_type(file.filename)[0] or "application/octet-stream"
-            upload_tasks.append(upload_single_file(file, file_path, content_type))
+            upload_tasks.append(upload_single_file(file, file_path, content_type, packed=use_pack and (file.size or 0) < PACK_THRESHOLD))
 
-        # Wait for all uploads to complete
-        files_data = await asyncio.gather(*upload_tasks)
+        # Wait for all uploads to complete, stopping the rest if one fails so cleanup sees every temp file
+        upload_tasks = [asyncio.ensure_future(task) for task in upload_tasks]
+        try:
+            files_data = await asyncio.gather(*upload_tasks)
+        except BaseException:
+            for task in upload_tasks:
+                task.cancel()
+            await asyncio.gather(*upload_tasks, return_exceptions=True)
+            raise
+
+        # Build and upload the pack object
+        pack_members = [f for f in files_data if "temp_file_path" in f]
+        if pack_members:
+            pack_path = f"{unique_folder}/.pack/{uuid.uuid4()}"
+            pack_temp_path = os.path.join(TEMP_UPLOAD_DIR, f"{uuid.uuid4()}_pack")
+            pack_temp_files.append(pack_temp_path)
+            await run_blocking(build_pack, pack_members, pack_temp_path)
+
+            if not await upload_to_b2(pack_temp_path, pack_path, rclone_path, rclone_config):
+                raise Exception("Failed to upload pack to B2")
+
+            print(f"Pack uploaded successfully: {B2_ENDPOINT}/{pack_path}")
+            for member in pack_members:
+                member["file_path"] = pack_path
+                del member["temp_file_path"]
 
         # Save metadata
         unique_id = str(uuid.uuid4())[:8]
-        save_file_metadata(unique_id, files_data)
+
+        # Packed and compressed objects are not usable directly from B2, point them at our download route
+        for file_info in files_data:
+            if "pack_offset" in file_info or file_info.get("encoding"):
+                file_info["url"] = f"/download/{unique_id}/{file_info['filename']}"
+        await run_blocking(save_file_metadata, unique_id, files_data)
         print(f"Saved metadata for upload ID: {unique_id}")
 
         # Final storage check
-        stats = get_storage_stats()
+        stats = await run_blocking(get_storage_stats)
         if stats and stats["percent"] > 90:
             print(f"WARNING: High storage usage after upload: {stats['percent']}%")
             # Trigger cleanup in background
-            cleanup_temp_storage()
+            await run_blocking(cleanup_temp_storage)
+
+        # Render previews after the response has been sent
+        if preview_jobs:
+            background_tasks.add_task(generate_previews, unique_id, unique_folder, preview_jobs)
+            previews_scheduled = True
 
         return JSONResponse(content={"message": "Upload successful", "files": files_data, "download_id": unique_id})
 
@@ -592,6 +1100,16 @@ async def upload_file(files: list[UploadFile] = File(...)):
         print(f"Unexpected error during upload: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
     finally:
+        # Clean up pack temporary files, and preview sources that were never handed off
+        if not previews_scheduled:
+            pack_temp_files.extend(job["source"] for job in preview_jobs)
+        for temp_path in pack_temp_files:
+            try:
+                if os.path.exists(temp_path):
+                    os.unlink(temp_path)
+            except Exception as e:
+                print(f"Error cleaning up pack temporary file: {str(e)}")
+
         # Clean up config file
         try:
             if os.path.exists(rclone_config):
@@ -617,7 +1135,7 @@ async def file_page(request: Request, file_id: str, background_tasks: Background
     # Clean up expired files in the background
     cleanup_expired_files(background_tasks)
 
-    file_data = get_file_metadata(file_id)
+    file_data = await run_blocking(get_file_metadata, file_id)
 
     if not file_data:
         return templates.TemplateResponse("error.html", {
@@ -641,7 +1159,9 @@ async def file_page(request: Request, file_id: str, background_tasks: Background
             "filename": file["filename"],
             "size": size,
             "size_formatted": formatted_size,
-            "download_url": f"/download/{file_id}/{file['filename']}"
+            "download_url": f"/download/{file_id}/{file['filename']}",
+            "preview_url": f"/preview/{file_id}/{file['filename']}" if file.get("preview_path") else None,
+            "preview_type": file.get("preview_type")
         })
 
     # Format dates
@@ -662,12 +1182,12 @@ async def file_page(request: Request, file_id: str, background_tasks: Background
 
 
 @app.get("/download/{file_id}/{filename}")
-async def download_file(file_id: str, filename: str, background_tasks: BackgroundTasks):
+async def download_file(request: Request, file_id: str, filename: str, background_tasks: BackgroundTasks):
     # Clean up expired files in the background
     cleanup_expired_files(background_tasks)
 
     try:
-        file_data = get_file_metadata(file_id)
+        file_data = await run_blocking(get_file_metadata, file_id)
         if not file_data:
             raise HTTPException(status_code=404, detail="Files not found")
 
@@ -683,13 +1203,34 @@ async def download_file(file_id: str, filename: str, background_tasks: Backgroun
         file_url = requested_file["url"]
         content_type = requested_file.get("content_type", "application/octet-stream")
 
+        # Pass compressed objects through when the client can decode them, otherwise decompress on the fly
+        encoding = requested_file.get("encoding")
+        passthrough = bool(encoding) and accepts_encoding(request.headers.get("accept-encoding", ""), encoding)
+        decompress_encoding = encoding if encoding and not passthrough else None
+        if decompress_encoding and not can_decompress(decompress_encoding):
+            raise ValueError(f"Unsupported content encoding: {decompress_encoding}")
+
+        # Packed files are read as a byte range of the transfer's pack object
+        range_args = []
+        if "pack_offset" in requested_file:
+            range_args = ["--offset", str(requested_file["pack_offset"]), "--count", str(requested_file["pack_length"])]
+
         # Use rclone to stream the file
-        rclone_path = ensure_rclone()
-        rclone_config = create_rclone_config()
+        rclone_path = await run_blocking(ensure_rclone)
+        rclone_config = await run_blocking(create_rclone_config)
 
         async def file_stream():
             process = None
+            reader = None
+            source = None
+            stdout = asyncio.subprocess.PIPE
             try:
+                if decompress_encoding:
+                    # Decompress from a plain pipe so every read is bounded by the requested size
+                    read_fd, stdout = os.pipe()
+                    source = os.fdopen(read_fd, "rb")
+                    reader = open_decompressing_reader(decompress_encoding, source)
+
                 process = await asyncio.create_subprocess_exec(
                     rclone_path,
                     "--config", rclone_config,
@@ -699,16 +1240,32 @@ async def download_file(file_id: str, filename: str, background_tasks: Backgroun
                     "--timeout", "30s",
                     "--retries", "3",
                     "--low-level-retries", "10",
+                    *range_args,
                     f"b2:{B2_BUCKET_NAME}/{requested_file['file_path']}",
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
+                    stdout=stdout,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=MIN_CHUNK_SIZE
                 )
+                if reader is not None:
+                    os.close(stdout)  # Only rclone keeps the write end open
 
+                # Adapt read size to how fast this client drains the stream
+                tracker = ThroughputTracker(max_size=DECOMPRESS_MAX_READ_SIZE if reader is not None else MAX_CHUNK_SIZE)
+                loop = asyncio.get_running_loop()
                 while True:
-                    chunk = await process.stdout.read(CHUNK_SIZE)
+                    chunk_start = time.monotonic()
+                    if reader is not None:
+                        # read1 returns whatever is ready instead of waiting for a full chunk from B2
+                        chunk = await loop.run_in_executor(decompress_executor, reader.read1, tracker.chunk_size)
+                    else:
+                        try:
+                            chunk = await process.stdout.readexactly(tracker.chunk_size)
+                        except asyncio.IncompleteReadError as e:
+                            chunk = e.partial  # End of stream
                     if not chunk:
                         break
                     yield chunk
+                    tracker.record(len(chunk), time.monotonic() - chunk_start)
 
                 # Check for any errors after streaming is complete
                 stderr = await process.stderr.read()
@@ -727,13 +1284,29 @@ async def download_file(file_id: str, filename: str, background_tasks: Backgroun
                         pass
                 raise
             finally:
-                # Clean up config
+                # Everything here is synchronous: on client disconnect the task is cancelled and any await would raise again
                 try:
                     if os.path.exists(rclone_config):
                         os.remove(rclone_config)
                 except Exception as e:
                     print(f"Error cleaning up rclone config: {str(e)}")
 
+                # Kill rclone if it is still running, asyncio's child watcher reaps it
+                if process is not None and process.returncode is None:
+                    try:
+                        process.kill()
+                    except ProcessLookupError:
+                        pass
+
+                if reader is not None:
+                    try:
+                        if process is None:
+                            os.close(stdout)
+                        reader.close()
+                        source.close()
+                    except Exception as e:
+                        print(f"Error closing decompressing reader: {str(e)}")
+
         # Set appropriate headers for the response
         headers = {
             "Content-Disposition": f'attachment; filename="{filename}"',
@@ -741,6 +1314,10 @@ async def download_file(file_id: str, filename: str, background_tasks: Backgroun
             "Pragma": "no-cache",
             "Expires": "0"
         }
+        if encoding:
+            headers["Vary"] = "Accept-Encoding"
+        if passthrough:
+            headers["Content-Encoding"] = encoding
 
         return StreamingResponse(file_stream(), media_type=content_type, headers=headers)
 
@@ -751,6 +1328,60 @@ async def download_file(file_id: str, filename: str, background_tasks: Backgroun
         raise HTTPException(status_code=500, detail=f"Download failed: {str(e)}")
 
 
+@app.get("/preview/{file_id}/{filename}")
+async def preview_file(request: Request, file_id: str, filename: str):
+    file_data = await run_blocking(get_file_metadata, file_id)
+    if not file_data or file_data.get("expiry_date", 0) < int(time.time()):
+        raise HTTPException(status_code=404, detail="Preview not found")
+
+    requested_file = next((f for f in file_data.get("files", []) if f["filename"] == filename), None)
+    if not requested_file or not requested_file.get("preview_path"):
+        raise HTTPException(status_code=404, detail="Preview not found")
+
+    rclone_path = await run_blocking(ensure_rclone)
+    rclone_config = await run_blocking(create_rclone_config)
+    try:
+        # Previews are small, read them in one go
+        process = await asyncio.create_subprocess_exec(
+            rclone_path,
+            "--config", rclone_config,
+            "cat",
+            "--no-traverse",
+            "--contimeout", "30s",
+            "--timeout", "30s",
+            f"b2:{B2_BUCKET_NAME}/{requested_file['preview_path']}",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        content, stderr = await process.communicate()
+        if process.returncode != 0:
+            print(f"Rclone error: {stderr.decode()}")
+            raise HTTPException(status_code=502, detail="Failed to load preview")
+    finally:
+        try:
+            if os.path.exists(rclone_config):
+                os.remove(rclone_config)
+        except Exception as e:
+            print(f"Error cleaning up rclone config: {str(e)}")
+
+    # Previews are immutable, let browsers and proxies cache them until the files expire
+    max_age = max(0, file_data.get("expiry_date", 0) - int(time.time()))
+    headers = {"Cache-Control": f"public, max-age={max_age}, immutable", "Accept-Ranges": "bytes"}
+    media_type = requested_file.get("preview_content_type", "application/octet-stream")
+
+    # Safari only plays <video> from servers that answer byte-range requests
+    try:
+        byte_range = parse_byte_range(request.headers.get("range"), len(content))
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{len(content)}"})
+    if byte_range is None:
+        return Response(content=content, media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(content)}"
+    return Response(content=content[start:end + 1], status_code=206, media_type=media_type, headers=headers)
+
+
 if __name__ == "__main__":
     import uvicorn
 